@@ -1,16 +1,33 @@
+import asyncio
+import collections
+import csv
+import hashlib
+import io
+import itertools
 import json
+import logging
+import math
 import os
 import re
+import secrets
 import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from urllib.parse import unquote_plus
 
 import sqlite_utils
 from datasette import hookimpl, database as ds_database
-from datasette.utils.asgi import Response, Forbidden
+from datasette.utils.asgi import AsgiStream, Response, Forbidden
 
 
+logger = logging.getLogger(__name__)
+
 DB_NAME="live_permissions"
 DEFAULT_DBPATH="."
+DEFAULT_STORAGE="sqlite"
 BLOCKED_DB_ACTIONS = [
     "live_permissions", "live_config",
     "_internal", "_memory",
@@ -20,32 +37,582 @@ BLOCKED_DB_ACTIONS = [
 # used to check all required tables exist and for table specified
 # in the CRUD endpoint
 KNOWN_TABLES = [
-    "users", "groups", "group_membership", "actions_resources", "permissions"
+    "users", "groups", "group_membership", "actions_resources", "permissions",
+    "tokens",
+]
+# primary keys for KNOWN_TABLES not using "id"
+TABLE_PKS = {
+    "group_membership": ("group_id", "user_id"),
+}
+
+# tables whose rows can be granted temporarily via an expires_at
+# column (unix timestamp, null means never expires)
+EXPIRING_TABLES = ["permissions", "group_membership", "tokens"]
+# appended to queries against EXPIRING_TABLES, expects a :now param
+NOT_EXPIRED = "(expires_at is null or expires_at > :now)"
+# how long (seconds) the expiry sweeper sleeps when nothing is due
+DEFAULT_SWEEP_INTERVAL = 60
+# how many expired rows get deleted per sweep transaction
+DEFAULT_SWEEP_BATCH_SIZE = 500
+# append-only log of row changes to the KNOWN_TABLES, filled by triggers
+# and read by the editor's change feed
+CHANGE_LOG_TABLE = "change_log"
+# columns kept out of the change_log (and so the change feed)
+CHANGE_LOG_SKIP_COLUMNS = {
+    "tokens": ["token_hash"],
+}
+# how many change_log entries the sweeper leaves behind
+DEFAULT_CHANGE_LOG_SIZE = 10000
+# how long (seconds) a change feed request waits for new changes
+DEFAULT_CHANGES_TIMEOUT = 25
+MAX_CHANGES_TIMEOUT = 55
+CHANGES_POLL_INTERVAL = 0.5
+# SQL version of resource_key(), used by the actions_resources triggers
+RESOURCE_KEY_SQL = """
+    case
+        when resource_primary is null and resource_secondary is null then ''
+        when resource_secondary is null then resource_primary
+        else ifnull(resource_primary, '') || '/' || resource_secondary
+    end
+"""
+# how many rows the access report fetches and streams at a time
+REPORT_BATCH_SIZE = 1000
+REPORT_COLUMNS = ["id", "lookup", "value", "description", "direct", "via"]
+# how many permission check traces are kept when tracing is on
+DEFAULT_TRACE_SIZE = 100
+# statements that EXPLAIN QUERY PLAN can tell us something about
+EXPLAINABLE_SQL = re.compile(r"^\s*(select|with|insert|update|delete)\b", re.I)
+# API tokens look like "dlp_...", only their hashes are stored
+TOKEN_PREFIX = "dlp_"
+# the "token" key of the actors for API tokens
+TOKEN_ACTOR_TYPE = "live_permissions"
+# lookup of the users added for tokens (value: the token id). It doesn't
+# start with "actor", so no actor can ever match these users
+TOKEN_USER_LOOKUP = "live_permissions.token"
+# how long (seconds) resolved tokens are cached for
+DEFAULT_TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 10000
+EXPIRES_AT_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
 ]
 
 
+def get_config(datasette):
+    if not datasette:
+        return {}
+    return datasette.plugin_config("datasette-live-permissions") or {}
+
+
 def get_db_path(datasette):
-    config = datasette.plugin_config("datasette-live-permissions") or {}
+    config = get_config(datasette)
     default_db_path = config.get("db_path", DEFAULT_DBPATH)
     return os.path.join(default_db_path, f"{DB_NAME}.db")
 
 
+class SQLTracer:
+    """
+    Records every SQL statement run during a permission check, with its
+    parameters, duration and query plan. Enabled with the "trace" plugin
+    config option, the latest traces can be seen at /-/live-permissions/trace
+    """
+    def __init__(self, size=DEFAULT_TRACE_SIZE):
+        self.traces = collections.deque(maxlen=size)
+        # the running trace is per thread, so statements from other
+        # threads never end up in a permission check's trace
+        self.local = threading.local()
+
+    @property
+    def current(self):
+        return getattr(self.local, "current", None)
+
+    @current.setter
+    def current(self, trace):
+        self.local.current = trace
+
+    def start(self, **info):
+        self.current = dict(info, statements=[], started=time.perf_counter())
+
+    def record(self, sql, parameters, duration, plan):
+        if self.current is None:
+            return
+        self.current["statements"].append({
+            "sql": sql,
+            "params": parameters,
+            "duration_ms": duration * 1000,
+            "plan": plan,
+        })
+
+    def finish(self, **info):
+        trace = self.current
+        self.current = None
+        if trace is None:
+            return None
+        started = trace.pop("started")
+        trace.update(info)
+        trace["duration_ms"] = (time.perf_counter() - started) * 1000
+        self.traces.append(trace)
+        return trace
+
+
+def explain_query_plan(conn, sql, parameters=None):
+    """
+    Returns the EXPLAIN QUERY PLAN details for a statement, e.g.,
+    ["SEARCH users USING INDEX idx_users_lookup_value (lookup=? AND value=?)"]
+    or None if it can't be explained.
+    """
+    if not EXPLAINABLE_SQL.match(sql):
+        return None
+    try:
+        rows = conn.execute(f"explain query plan {sql}", parameters or []).fetchall()
+    except sqlite3.Error:
+        return None
+    return [row[-1] for row in rows]
+
+
+class TracingDatabase(sqlite_utils.Database):
+    """
+    sqlite_utils.Database that reports everything it executes, while a
+    trace is running, to a SQLTracer.
+    """
+    def __init__(self, conn, sql_tracer):
+        # set first, the parent constructor already executes statements
+        self.sql_tracer = sql_tracer
+        super().__init__(conn)
+
+    def execute(self, sql, parameters=None):
+        if self.sql_tracer.current is None:
+            return super().execute(sql, parameters)
+        # explain first: the statement itself may change what's explained
+        plan = explain_query_plan(self.conn, sql, parameters)
+        started = time.perf_counter()
+        cursor = super().execute(sql, parameters)
+        self.sql_tracer.record(
+            sql, parameters, time.perf_counter() - started, plan
+        )
+        return cursor
+
+
+class PermissionStore:
+    """
+    The storage interface: everything the plugin's hooks, routes and
+    background tasks do with the permissions database goes through these
+    methods (setup, resolve_actor, resolve_resource, check, mutate, tokens,
+    the change feed, sweeping, reports and group membership lookups), run
+    on the store's worker thread via execute_fn.
+
+    This base class implements them on SQLite, subclasses only decide
+    where that database lives (see get_db). Another engine can be tried
+    by overriding the methods instead, e.g., to benchmark it against the
+    SQLite stores. Backends get registered in STORAGE_BACKENDS and are
+    selected with the "storage" plugin config option.
+    """
+    def __init__(self, datasette):
+        # weak, STORES is keyed by the Datasette instance and a strong
+        # reference here would keep it (and this store) alive forever
+        self.datasette_ref = weakref.ref(datasette) if datasette else None
+        # everything touching the store's connection runs on this one
+        # thread, off the event loop, see execute_fn and allowed_async
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        weakref.finalize(self, self.executor.shutdown, False)
+        self.in_flight = {}
+        # the sweep_expired_forever task, started on startup
+        self.sweeper = None
+        # ("hash", token_hash) or ("id", id) -> (cached at, row), see get_token
+        # least recently used first
+        self.token_cache = collections.OrderedDict()
+        self.token_cache_ttl = get_config(datasette).get(
+            "token_cache_ttl", DEFAULT_TOKEN_CACHE_TTL
+        )
+        self.sql_tracer = None
+        if get_config(datasette).get("trace"):
+            self.sql_tracer = SQLTracer()
+
+    @property
+    def datasette(self):
+        if self.datasette_ref is None:
+            return None
+        return self.datasette_ref()
+
+    def wrap_conn(self, conn):
+        # close the connection along with the store
+        weakref.finalize(self, conn.close)
+        if self.sql_tracer:
+            return TracingDatabase(conn, self.sql_tracer)
+        return sqlite_utils.Database(conn)
+
+    def get_db(self):
+        """
+        Returns a sqlite_utils.Database, not datasette.Database, but a
+        datasette Database can be got through datasette.databases[DB_NAME]
+        after this runs.
+        """
+        raise NotImplementedError
+
+    async def execute_fn(self, fn):
+        """
+        Run fn(db) on the store's worker thread and return the result. All
+        database access from the event loop goes through here (permission
+        checks already run on the worker), so callers never share the
+        connection at the same time and their transactions can't interleave.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, lambda: fn(self.get_db())
+        )
+
+    def setup(self):
+        """
+        Create the tables, indexes and triggers, and the default users,
+        groups and permissions.
+        """
+        create_tables(self.datasette)
+
+    def resolve_actor(self, actor):
+        """
+        Returns the rows of the users matching the actor, adding new
+        users as needed.
+        """
+        if actor and actor.get("token") == TOKEN_ACTOR_TYPE:
+            return self.resolve_token_actor(actor)
+        return bootstrap_and_fetch_users(self.get_db(), actor)
+
+    def resolve_token_actor(self, actor):
+        """
+        Users for an API token actor: the "everyone" user plus the user
+        the token is linked to, without matching the actor against all
+        the lookups in the users table.
+        """
+        relevant_users = bootstrap_and_fetch_users(self.get_db(), None)
+        token = self.get_token(token_id=actor.get("token_id"))
+        if token and token["user_id"] is not None:
+            relevant_users.append((token["user_id"],))
+        return relevant_users
+
+    def get_token(self, token_hash=None, token_id=None):
+        """
+        Returns the (non-expired) tokens row for a token hash or id, or None.
+        Rows are cached for token_cache_ttl seconds, so revoking a token
+        outside the plugin (e.g., via SQL) can take that long to apply.
+        Misses aren't cached, so unknown tokens can't push out real ones.
+        """
+        if token_hash:
+            key, query, param = ("hash", token_hash), "token_hash = ?", token_hash
+        elif token_id is not None:
+            key, query, param = ("id", token_id), "id = ?", token_id
+        else:
+            return None
+        now = time.time()
+        cached = self.token_cache.get(key)
+        if cached is not None and cached[0] + self.token_cache_ttl >= now:
+            self.token_cache.move_to_end(key)
+            token = cached[1]
+        else:
+            # a single probe on the token_hash index (or primary key)
+            row = self.get_db().execute(
+                "select id, token_hash, user_id, expires_at from tokens "
+                f"where {query}", [param]
+            ).fetchone()
+            self.token_cache.pop(key, None)
+            if not row:
+                return None
+            token = dict(zip(["id", "token_hash", "user_id", "expires_at"], row))
+            self.token_cache[key] = (now, token)
+            if len(self.token_cache) > TOKEN_CACHE_SIZE:
+                self.token_cache.popitem(last=False)
+        if token["expires_at"] is not None and token["expires_at"] <= now:
+            return None
+        return token
+
+    def create_token(self, user_id=None, description=None, expires_at=None):
+        """
+        Create an API token and return (token id, secret token). Only the
+        hash gets stored, so the secret can't be shown again. Without a
+        user_id, a new user is added for the token (see TOKEN_USER_LOOKUP)
+        so it can be granted permissions and added to groups. That user is
+        only reachable through tokens.user_id.
+        """
+        db = self.get_db()
+        secret = f"{TOKEN_PREFIX}{secrets.token_urlsafe(32)}"
+        token_id = db["tokens"].insert({
+            "token_hash": hash_token(secret),
+            "user_id": user_id,
+            "description": description,
+            "expires_at": expires_at,
+        }, pk="id").last_pk
+        if user_id is None:
+            # a plain insert, token ids are never reused so this can't
+            # collide with (or replace) another user
+            user_id = db["users"].insert({
+                "lookup": TOKEN_USER_LOOKUP,
+                "value": str(token_id),
+                "description": description,
+            }).last_pk
+            db["tokens"].update(token_id, {"user_id": user_id})
+        return token_id, secret
+
+    def resolve_resource(self, action, resource):
+        """
+        Returns the rows of the actions_resources matching the action and
+        resource (including parent resources), adding new ones as needed.
+        """
+        return bootstrap_and_fetch_actions_resources(
+            self.get_db(), action, resource
+        )
+
+    def check(self, actor, action, resource, authed_users, relevant_actions):
+        return check_permission(
+            actor, action, resource, self.get_db(), authed_users,
+            relevant_actions
+        )
+
+    def mutate(self, table, op, data=None, pk=None):
+        """
+        Change a row in one of the KNOWN_TABLES. op is one of "insert" (fails
+        if the row exists), "upsert" or "delete" (by pk).
+        """
+        assert table in KNOWN_TABLES, "Bad table name provided"
+        db = self.get_db()
+        if op == "insert":
+            db[table].insert(
+                data, pk=TABLE_PKS.get(table, "id"), alter=False, replace=False
+            )
+        elif op == "upsert":
+            db[table].insert(
+                data, pk=TABLE_PKS.get(table, "id"), alter=False, replace=True
+            )
+        elif op == "delete":
+            db[table].delete(pk)
+        else:
+            raise NotImplementedError(f"Bad operation: {op}")
+        if table == "tokens":
+            self.token_cache.clear()
+
+    def change_version(self):
+        """
+        The version of the latest change, see changes.
+        """
+        return latest_change_version(self.get_db())
+
+    def oldest_change_version(self):
+        """
+        The oldest version still in the change log (older ones have been
+        trimmed), or None if it's empty.
+        """
+        return self.get_db().execute(
+            f"select min(version) from [{CHANGE_LOG_TABLE}]"
+        ).fetchone()[0]
+
+    def changes(self, since, table=None):
+        """
+        The row changes after the since version, see fetch_changes.
+        """
+        return fetch_changes(self.get_db(), since, table)
+
+    def sweep(self, batch_size=DEFAULT_SWEEP_BATCH_SIZE,
+              change_log_size=DEFAULT_CHANGE_LOG_SIZE):
+        """
+        Delete expired rows and trim the change log. Returns when the next
+        row is due to expire (a unix timestamp), or None.
+        """
+        db = self.get_db()
+        sweep_expired(db, batch_size=batch_size)
+        trim_change_log(db, keep=change_log_size)
+        return next_expiry(db)
+
+    def access_report(self, action, database=None, table=None):
+        """
+        An iterator over the rows (REPORT_COLUMNS) of the users with access
+        to an action and resource. It's read in batches, on this thread.
+        """
+        return access_report(self.get_db(), action, database, table)
+
+    def find_group(self, name):
+        """
+        The id of the group with this name, or None.
+        """
+        row = self.get_db().execute(
+            "select id from groups where name = ?", [name]
+        ).fetchone()
+        return row[0] if row else None
+
+    def group_members(self, group_id):
+        """
+        The (id, lookup, value, description) of the users in a group.
+        """
+        return self.get_db().execute("""
+            select distinct user_id as id, lookup, value, description
+            from group_membership join users
+            on group_membership.user_id = users.id
+            where group_membership.group_id=?
+        """, [group_id]).fetchall()
+
+    def allowed(self, actor, action, resource):
+        if self.sql_tracer:
+            self.sql_tracer.start(actor=actor, action=action, resource=resource)
+        result = None
+        try:
+            authed_users = self.resolve_actor(actor)
+            relevant_actions = self.resolve_resource(action, resource)
+            result = self.check(
+                actor, action, resource, authed_users, relevant_actions
+            )
+        finally:
+            if self.sql_tracer:
+                self.sql_tracer.finish(allowed=result)
+        return result
+
+    async def allowed_async(self, actor, action, resource):
+        """
+        Run allowed() in the store's worker thread. Identical checks that
+        come in while one is already running (e.g., the many view-instance
+        checks on a page load) wait for that one instead of doing their
+        own lookups and bootstrap inserts.
+        """
+        key = check_key(actor, action, resource)
+        future = self.in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(
+                self.executor, self.allowed, actor, action, resource
+            )
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+        # one waiter getting cancelled shouldn't cancel it for the others
+        return await asyncio.shield(future)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def check_key(actor, action, resource):
+    """
+    Key identifying identical permission checks, for PermissionStore.allowed_async
+    """
+    return json.dumps([actor, action, resource], sort_keys=True, default=repr)
+
+
+class SQLiteStore(PermissionStore):
+    """
+    Stores permissions in live_permissions.db, in the configured db_path.
+    """
+    def __init__(self, datasette):
+        super().__init__(datasette)
+        self.db = None
+
+    def get_db(self):
+        # this will create the DB if not exists
+        database_path = get_db_path(self.datasette)
+        # re-use one connection instead of opening one per call
+        if self.db is None:
+            self.db = self.wrap_conn(
+                sqlite3.connect(database_path, check_same_thread=False)
+            )
+        db = self.db
+        # just make it show up in the DBs list
+        if self.datasette and not (DB_NAME in self.datasette.databases):
+            self.datasette.add_database(
+                ds_database.Database(
+                    self.datasette, path=database_path, is_mutable=True
+                ),
+                name=DB_NAME,
+            )
+        return db
+
+
+class MemoryStore(PermissionStore):
+    """
+    Stores permissions in a named, shared-cache in-memory SQLite database,
+    so nothing touches the disk. It still shows up in Datasette, so the
+    editor works, but everything is lost on restart. Useful for tests and
+    ephemeral instances.
+    """
+    def __init__(self, datasette):
+        super().__init__(datasette)
+        # unique per store, so separate Datasette instances don't share one
+        self.memory_name = f"{DB_NAME}_{id(self)}"
+        # the in-memory DB only lives as long as a connection to it is open
+        self.db = self.wrap_conn(sqlite3.connect(
+            f"file:{self.memory_name}?mode=memory&cache=shared",
+            uri=True, check_same_thread=False,
+        ))
+
+    def get_db(self):
+        if self.datasette and not (DB_NAME in self.datasette.databases):
+            self.datasette.add_database(
+                MemoryStoreDatabase(self), name=DB_NAME,
+            )
+        return self.db
+
+
+class MemoryStoreDatabase(ds_database.Database):
+    """
+    How Datasette sees a MemoryStore. Shared-cache in-memory databases use
+    table locks that fail straight away instead of waiting (no busy
+    timeout), so a second connection reading a table would make the
+    store's writes fail. Instead, Datasette's queries run on the store's
+    own connection and worker thread, one at a time with everything else.
+    """
+    def __init__(self, store):
+        super().__init__(
+            store.datasette, memory_name=store.memory_name, is_mutable=True
+        )
+        self.store = store
+        conn = store.db.conn
+        # Datasette expects its row_factory, text_factory, SQL functions
+        # and extensions, the plugin's own queries expect plain tuples
+        own_factories = (conn.row_factory, conn.text_factory)
+        self.ds._prepare_connection(conn, DB_NAME)
+        self.factories = (conn.row_factory, conn.text_factory)
+        conn.row_factory, conn.text_factory = own_factories
+
+    def run(self, fn, conn):
+        own_factories = (conn.row_factory, conn.text_factory)
+        conn.row_factory, conn.text_factory = self.factories
+        try:
+            return fn(conn)
+        finally:
+            conn.row_factory, conn.text_factory = own_factories
+
+    async def execute_fn(self, fn):
+        return await self.store.execute_fn(lambda db: self.run(fn, db.conn))
+
+    async def execute_write_fn(self, fn, block=True):
+        return await self.store.execute_fn(lambda db: self.run(fn, db.conn))
+
+
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStore,
+    "memory": MemoryStore,
+}
+# one store per Datasette instance, see get_store
+STORES = weakref.WeakKeyDictionary()
+
+
+def get_store(datasette):
+    """
+    Returns the PermissionStore for this Datasette instance, as set by the
+    "storage" plugin config option (default: sqlite).
+    """
+    if not datasette:
+        return SQLiteStore(datasette)
+    if datasette not in STORES:
+        storage = get_config(datasette).get("storage", DEFAULT_STORAGE)
+        assert storage in STORAGE_BACKENDS, f"Bad storage backend: {storage}"
+        STORES[datasette] = STORAGE_BACKENDS[storage](datasette)
+    return STORES[datasette]
+
+
 def get_db(datasette):
     """
-    Returns a sqlite_utils.Database, not datasette.Database, but a datasette
+    Returns a sqlite_utils.Database for the configured store. A datasette
     Database can be got through datasette.databases[DB_NAME] after this runs.
     """
-    # this will create the DB if not exists
-    database_path = get_db_path(datasette)
-    conn = sqlite3.connect(database_path)
-    db = sqlite_utils.Database(conn)
-    # just make it show up in the DBs list
-    if datasette and not (DB_NAME in datasette.databases):
-        datasette.add_database(
-            ds_database.Database(datasette, path=database_path, is_mutable=True),
-            name=DB_NAME,
-        )
-    return db
+    return get_store(datasette).get_db()
 
 
 def make_query(preamble, key_values):
@@ -323,6 +890,7 @@ def create_tables(datasette):
         database["group_membership"].create({
             "group_id": int,
             "user_id": int,
+            "expires_at": float,
         }, pk=("group_id", "user_id"), foreign_keys=(
             ("user_id", "users", "id"),
             ("group_id", "groups", "id"),
@@ -339,12 +907,15 @@ def create_tables(datasette):
             "action": str,
             "resource_primary": str,
             "resource_secondary": str,
+            # maintained by a trigger, see ensure_resource_keys
+            "resource_key": str,
         }, pk="id", not_null=[
             "action",
         ])
         database["actions_resources"].create_index([
             "action", "resource_primary", "resource_secondary",
         ], unique=True)
+        ensure_resource_keys(database)
 
     if "permissions" not in table_names:
         database["permissions"].create({
@@ -352,6 +923,7 @@ def create_tables(datasette):
             "actions_resources_id": int,
             "user_id": int,
             "group_id": int,
+            "expires_at": float,
         }, pk="id", not_null=[
             "actions_resources_id",
         ], foreign_keys=(
@@ -371,6 +943,13 @@ def create_tables(datasette):
         ], unique=True)
         setup_default_permissions(datasette)
 
+    ensure_tokens(database)
+    ensure_expiry_columns(database)
+    ensure_resource_keys(database)
+    ensure_report_indexes(database)
+    ensure_check_indexes(database)
+    ensure_change_log(database)
+
     if have_live_config_plugin(datasette) and "__metadata" not in table_names:
         database["__metadata"].insert({
             "key": "tables",
@@ -387,13 +966,310 @@ def create_tables(datasette):
                     "hidden": False,
                     "label_column": "action"
                 },
+                "tokens": {
+                    "hidden": False,
+                    "label_column": "description"
+                },
                 "__metadata": {
                     "hidden": True
+                },
+                CHANGE_LOG_TABLE: {
+                    "hidden": True
                 }
             })
         }, pk="key", alter=True, replace=False)
 
 
+def ensure_tokens(database):
+    """
+    Create the tokens table, with AUTOINCREMENT ids so a deleted token's id
+    (and the user made for it) is never handed out again. Also add the
+    trigger that removes a token's user, its memberships and grants along
+    with the token, however it gets deleted (the editor, the sweeper, SQL,
+    etc). Only the user this plugin added for that token is removed.
+    """
+    if not database["tokens"].exists():
+        database.execute("""
+            create table tokens (
+                id integer primary key autoincrement,
+                -- sha256 of the token, the token itself is never stored
+                token_hash text not null,
+                user_id integer references users(id),
+                description text,
+                expires_at float
+            )
+        """)
+    database["tokens"].create_index(
+        ["token_hash"], unique=True, if_not_exists=True
+    )
+    token_user = (
+        "select id from users where id = old.user_id "
+        f"and lookup = '{TOKEN_USER_LOOKUP}' and value = cast(old.id as text)"
+    )
+    database.execute("drop trigger if exists tokens_delete_user")
+    database.execute(f"""
+        create trigger tokens_delete_user
+        after delete on tokens
+        begin
+            delete from permissions where user_id in ({token_user});
+            delete from group_membership where user_id in ({token_user});
+            delete from users where id in ({token_user});
+        end
+    """)
+
+
+def ensure_expiry_columns(database):
+    """
+    Add the expires_at column (and its index, used by the sweeper) to
+    tables created before temporary grants were supported.
+    """
+    for table in EXPIRING_TABLES:
+        if "expires_at" not in database[table].columns_dict:
+            database[table].add_column("expires_at", float)
+        database[table].create_index(["expires_at"], if_not_exists=True)
+
+
+def ensure_resource_keys(database):
+    """
+    Add and backfill the resource_key column on actions_resources, index
+    it for permission checks and keep it up to date with triggers (rows
+    get added through the Datasette UI, SQL, etc, not only this plugin).
+    """
+    ar = database["actions_resources"]
+    if "resource_key" not in ar.columns_dict:
+        ar.add_column("resource_key", str)
+    with database.conn:
+        database.execute(
+            f"update actions_resources set resource_key = {RESOURCE_KEY_SQL} "
+            "where resource_key is null"
+        )
+    ar.create_index(["action", "resource_key"], if_not_exists=True)
+    # rows inserted with a resource_key (e.g., by
+    # bootstrap_and_fetch_actions_resources) don't need the extra update,
+    # which would also add a second change_log entry
+    database.execute("drop trigger if exists actions_resources_key_insert")
+    database.execute("""
+        create trigger actions_resources_key_insert
+        after insert on actions_resources
+        when new.resource_key is null
+        begin
+            update actions_resources set resource_key = {}
+            where id = new.id;
+        end
+    """.format(RESOURCE_KEY_SQL))
+    database.execute("""
+        create trigger if not exists actions_resources_key_update
+        after update of resource_primary, resource_secondary on actions_resources
+        begin
+            update actions_resources set resource_key = {}
+            where id = new.id;
+        end
+    """.format(RESOURCE_KEY_SQL))
+
+
+def ensure_report_indexes(database):
+    """
+    Indexes for going from an action-resource to the users that have
+    access to it (the reverse of a permission check), see access_report.
+    """
+    database["permissions"].create_index(
+        ["actions_resources_id"], if_not_exists=True
+    )
+
+
+def ensure_check_indexes(database):
+    """
+    Indexes used by check_permission, on top of the ones created with the
+    tables. group_membership's primary key starts with group_id, so it
+    can't be used to find a user's groups.
+    """
+    database["group_membership"].create_index(
+        ["user_id", "group_id"], if_not_exists=True
+    )
+
+
+def ensure_change_log(database):
+    """
+    Create the change_log table and (re)create the triggers that record
+    every insert, update and delete on the KNOWN_TABLES into it. Triggers
+    are rebuilt every time so they pick up any newly added columns. The
+    CHANGE_LOG_SKIP_COLUMNS are never logged.
+    """
+    if CHANGE_LOG_TABLE not in database.table_names():
+        database[CHANGE_LOG_TABLE].create({
+            "version": int,
+            "table_name": str,
+            "op": str,
+            "pk": str,
+            "row": str,
+        }, pk="version", not_null=[
+            "table_name", "op", "pk",
+        ])
+    for table in KNOWN_TABLES:
+        skip = CHANGE_LOG_SKIP_COLUMNS.get(table, [])
+        columns = [
+            column for column in database[table].columns_dict.keys()
+            if column not in skip
+        ]
+        pks = database[table].pks
+        for op, ref in [("insert", "new"), ("update", "new"), ("delete", "old")]:
+            # pk is formatted like the CRUD endpoint expects, e.g., "1,2"
+            pk_sql = " || ',' || ".join([f"{ref}.[{pk}]" for pk in pks])
+            row_sql = "null"
+            if op != "delete":
+                row_sql = "json_object({})".format(", ".join([
+                    f"'{column}', {ref}.[{column}]" for column in columns
+                ]))
+            trigger = f"{table}_{CHANGE_LOG_TABLE}_{op}"
+            database.execute(f"drop trigger if exists [{trigger}]")
+            database.execute(f"""
+                create trigger [{trigger}] after {op} on [{table}]
+                begin
+                    insert into [{CHANGE_LOG_TABLE}] (table_name, op, pk, row)
+                    values ('{table}', '{op}', '' || {pk_sql}, {row_sql});
+                end
+            """)
+        # entries logged before the column was skipped
+        for column in skip:
+            with database.conn:
+                database.execute(
+                    f"update [{CHANGE_LOG_TABLE}] set row = json_remove(row, ?) "
+                    "where table_name = ? and json_extract(row, ?) is not null",
+                    [f"$.{column}", table, f"$.{column}"]
+                )
+
+
+def latest_change_version(db):
+    row = db.execute(f"select max(version) from [{CHANGE_LOG_TABLE}]").fetchone()
+    return row[0] or 0
+
+
+def fetch_changes(db, since, table=None):
+    """
+    Return all change_log entries after the given version, optionally
+    limited to a single table, as dicts ready to be sent to the editor.
+    """
+    data = {"since": since, "table_name": table}
+    query = (
+        f"select version, table_name, op, pk, row from [{CHANGE_LOG_TABLE}] "
+        "where version > :since"
+    )
+    if table:
+        query += " and table_name = :table_name"
+    query += " order by version"
+    return [{
+        "version": version,
+        "table": table_name,
+        "op": op,
+        "pk": pk,
+        "row": json.loads(row) if row else None,
+    } for version, table_name, op, pk, row in db.execute(query, data).fetchall()]
+
+
+def trim_change_log(db, keep=DEFAULT_CHANGE_LOG_SIZE):
+    """
+    Delete all but the newest `keep` change_log entries. Editors that
+    are further behind than this get told to reload the page.
+    """
+    with db.conn:
+        db.execute(
+            f"delete from [{CHANGE_LOG_TABLE}] where version <= ?",
+            [latest_change_version(db) - keep]
+        )
+
+
+def parse_expires_at(value):
+    """
+    Turn a submitted expires_at value into a unix timestamp. Accepts
+    blank values (never expires), unix timestamps and ISO-ish datetimes,
+    which are assumed to be UTC (e.g., from a datetime-local input).
+    Raises a ValueError for anything else.
+    """
+    if value is None or not str(value).strip():
+        return None
+    value = str(value).strip()
+    try:
+        timestamp = float(value)
+    except ValueError:
+        pass
+    else:
+        if not math.isfinite(timestamp):
+            raise ValueError(f"Bad expires_at value: {value}")
+        return timestamp
+    for fmt in EXPIRES_AT_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=timezone.utc).timestamp()
+    raise ValueError(f"Bad expires_at value: {value}")
+
+
+def sweep_expired(db, now=None, batch_size=DEFAULT_SWEEP_BATCH_SIZE):
+    """
+    Delete expired rows from the EXPIRING_TABLES, in batches so we never
+    hold the write lock for long. Returns the number of deleted rows.
+    """
+    if now is None:
+        now = time.time()
+    deleted = 0
+    for table in EXPIRING_TABLES:
+        while True:
+            # the subquery is a range search on the expires_at index
+            with db.conn:
+                cursor = db.execute(
+                    f"delete from [{table}] where rowid in ("
+                    f"select rowid from [{table}] where expires_at <= ? "
+                    "limit ?)", [now, batch_size]
+                )
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+    return deleted
+
+
+def next_expiry(db):
+    """
+    Returns the soonest expires_at timestamp across the EXPIRING_TABLES,
+    or None if nothing is set to expire. Uses the expires_at index.
+    """
+    soonest = None
+    for table in EXPIRING_TABLES:
+        row = db.execute(f"select min(expires_at) from [{table}]").fetchone()
+        if row and row[0] is not None and (soonest is None or row[0] < soonest):
+            soonest = row[0]
+    return soonest
+
+
+async def sweep_expired_forever(store):
+    """
+    Background task that removes expired permissions and group memberships.
+    Sleeps until the next row is due to expire (or the configured interval,
+    whichever is sooner, so newly added grants get picked up). Stops once
+    the store's Datasette instance is gone.
+    """
+    config = get_config(store.datasette)
+    interval = config.get("expiry_sweep_interval", DEFAULT_SWEEP_INTERVAL)
+    batch_size = config.get("expiry_sweep_batch_size", DEFAULT_SWEEP_BATCH_SIZE)
+    change_log_size = config.get("change_log_size", DEFAULT_CHANGE_LOG_SIZE)
+
+    while store.datasette is not None:
+        delay = interval
+        try:
+            soonest = await store.execute_fn(lambda db: store.sweep(
+                batch_size=batch_size, change_log_size=change_log_size
+            ))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # e.g., the database is locked, try again next time around
+            logger.exception("Failed to sweep expired permissions")
+        else:
+            if soonest is not None:
+                delay = min(interval, max(0, soonest - time.time()))
+        await asyncio.sleep(delay)
+
+
 # TODO: on startup, create DB
 # Permission: action, actor, resource (optional)
 # Table: permissions
@@ -404,7 +1280,9 @@ def create_tables(datasette):
 def startup(datasette):
     async def inner():
         # db = get_or_create_db(datasette)
-        create_tables(datasette)
+        store = get_store(datasette)
+        await store.execute_fn(lambda db: store.setup())
+        store.sweeper = asyncio.ensure_future(sweep_expired_forever(store))
         # table_names = await db.table_names()
         # if "groups" not in table_names:
         #     await db.execute_write_fn(build_table)
@@ -438,10 +1316,26 @@ def flat_ids(rows):
 
 
 def get_lookups(db):
-    # TODO: replace with a separate lookup table
-    return db.execute(
-        "select lookup from users where lookup != 'actor' group by lookup;"
-    ).fetchall()
+    """
+    The distinct "actor.*" lookups in the users table. Instead of reading
+    the whole (lookup, value) index, this jumps from one lookup to the
+    next, so the cost grows with the number of lookups, not users. Other
+    lookups ("actor" for everyone, token users) can't match an actor.
+    """
+    return db.execute("""
+        with recursive lookups(lookup) as (
+            select (
+                select min(lookup) from users
+                where lookup >= 'actor.' and lookup < 'actor/'
+            )
+            union all
+            select (
+                select min(lookup) from users
+                where lookup > lookups.lookup and lookup < 'actor/'
+            ) from lookups where lookup is not null
+        )
+        select lookup from lookups where lookup is not null
+    """).fetchall()
 
 
 def bootstrap_and_fetch_users(db, actor):
@@ -486,9 +1380,11 @@ def bootstrap_and_fetch_users(db, actor):
                 lookup_values[lookup] = value
             lookup_clauses.append("(lookup = ? and value = ?)")
             lookup_args.append(value)
-        where_conditions = " or ".join(lookup_clauses)
-        query = f"select id from [users] where {where_conditions}"
-        results = db.execute(query, lookup_args).fetchall()
+        results = []
+        if lookup_clauses:
+            where_conditions = " or ".join(lookup_clauses)
+            query = f"select id from [users] where {where_conditions}"
+            results = db.execute(query, lookup_args).fetchall()
         if not len(results):
             # github auth plugin support
             if actor.get("gh_email"):
@@ -512,79 +1408,158 @@ def bootstrap_and_fetch_users(db, actor):
     return relevant_users
 
 
+def resource_key(resource_primary=None, resource_secondary=None):
+    """
+    Build the hierarchical key for a resource, the same way RESOURCE_KEY_SQL
+    does: "" for the whole instance, "db" for a database and "db/table" for
+    a table, query, etc.
+    """
+    if resource_primary is None and resource_secondary is None:
+        return ""
+    if resource_secondary is None:
+        return resource_primary
+    return f"{resource_primary or ''}/{resource_secondary}"
+
+
+def ancestor_resource_keys(resource):
+    """
+    Returns the keys of a resource and all of its parents, from the
+    instance level down, or None if the resource can't be represented.
+
+    E.g., ("db", "table") returns ["", "db", "db/table"]
+    """
+    if not resource:
+        return [resource_key()]
+    if isinstance(resource, str):
+        return [resource_key(), resource_key(resource)]
+    # NOTE: we probably don't need this since resources always have actions
+    # we could rely on
+    if isinstance(resource, (tuple, list)) and len(resource) == 2:
+        resource_primary, resource_secondary = resource
+        return [
+            resource_key(),
+            resource_key(resource_primary),
+            resource_key(resource_primary, resource_secondary),
+        ]
+    # TODO: figure out a better way to store more complex resources. one
+    # idea is to have a table that expresses more complex lookups, similar
+    # to my plans with users. For now, just serialize the resource and
+    # leave it at that
+    return None
+
+
 def bootstrap_and_fetch_actions_resources(db, action, resource):
-    ar = db["actions_resources"]
+    """
+    Fetch the actions_resources rows that apply to this check: the ones for
+    the resource itself and all of its ancestors (a grant on a database
+    applies to all its tables, a grant with no resource applies to
+    everything), in a single lookup on the (action, resource_key) index.
+
+    Missing rows for the action and the top-level resource (e.g., the
+    database) are created so they're easy to grant via the UI. Rows for
+    individual tables aren't, add those by hand when needed.
+    """
+    if not action:
+        return None
+    keys = ancestor_resource_keys(resource)
+    if keys is None:
+        return None
 
-    relevant_actions = []
-    if action:
-        data = {"action": action}
-        query = (
-            "select id from actions_resources where action = :action "
-            "and resource_primary is null and resource_secondary is null"
-        )
-        relevant_actions = db.execute(query, data).fetchall()
-        if not len(relevant_actions):
+    placeholders = ", ".join(["?"] * len(keys))
+    query = (
+        "select id, resource_key from actions_resources "
+        f"where action = ? and resource_key in ({placeholders})"
+    )
+    relevant_actions = db.execute(query, [action] + keys).fetchall()
+
+    found_keys = set([r[1] for r in relevant_actions])
+    ar = db["actions_resources"]
+    bootstrap = [{"action": action, "resource_key": resource_key()}]
+    if resource:
+        resource_primary = resource if isinstance(resource, str) else resource[0]
+        bootstrap.append({
+            "action": action,
+            "resource_primary": resource_primary,
+            "resource_key": resource_key(resource_primary),
+        })
+    for data in bootstrap:
+        if data["resource_key"] not in found_keys:
             ar.insert(data, pk="id", replace=True)
 
-    if resource and action:
-        if isinstance(resource, str):
-            data = {"action": action, "resource_primary": resource}
-            query = make_query("select id from actions_resources where", data)
-            results = db.execute(query, data).fetchall()
-            if not len(results):
-                ar.insert(data, pk="id", replace=True)
-            else:
-                relevant_actions += results
-
-        # NOTE: we probably don't need this since resources always have actions
-        # we could rely on
-        elif isinstance(resource, (tuple, list)) and len(resource) == 2:
-            resource_primary, resource_secondary = resource
-
-            # do a primary only query first
-            data = {
-                "action": action,
-                "resource_primary": resource_primary,
-                "resource_secondary": None
-            }
-            query = make_query("select id from actions_resources where", data)
-            results = db.execute(query, data).fetchall()
-            if len(results):
-                relevant_actions += results
-
-            # then do a primary w/ secondary check
-            data = {
-                "action": action,
-                "resource_primary": resource_primary,
-                "resource_secondary": resource_secondary
-            }
-            query = make_query("select id from actions_resources where", data)
-            results = db.execute(query, data).fetchall()
-            if not len(results):
-                # only do the insert here for primary w/ secondary
-                # (and not above) because this one is user-initiated
-                ar.insert(data, pk="id", replace=True)
-            else:
-                relevant_actions += results
+    return relevant_actions or None
 
-        # TODO: figure out a better way to store more complex resources. one
-        # idea is to have a table that expresses more complex lookups, similar
-        # to my plans with users. For now, just serialize the resource and
-        # leave it at that
-        else:
-            return None
 
-    return relevant_actions or None
+def access_report(db, action, database=None, table=None):
+    """
+    Returns a cursor over the users with access to an action and resource,
+    directly or through (non-expired) group memberships. "direct" is 1
+    when the user has a grant of their own, "via" lists the groups granting
+    access (null if none), so a user can have both.
+
+    Grants on parent resources count, just like in a permission check.
+    If only a database is given, grants on any of its tables count too,
+    so the report covers access to the whole database.
+    """
+    resource = database
+    if database is not None and table is not None:
+        resource = (database, table)
+    keys = ancestor_resource_keys(resource)
+    data = {"action": action, "now": time.time()}
+    key_conditions = []
+    for i, key in enumerate(keys):
+        data[f"key{i}"] = key
+        key_conditions.append(f"ar.resource_key = :key{i}")
+    if database is not None and table is None:
+        # all the database's tables: "db/..." sorts between "db/" and "db0"
+        data["child_start"] = f"{database}/"
+        data["child_end"] = f"{database}0"
+        key_conditions.append(
+            "(ar.resource_key >= :child_start and ar.resource_key < :child_end)"
+        )
+    query = f"""
+        with grants as (
+            select p.user_id, p.group_id
+            from actions_resources ar
+            join permissions p on p.actions_resources_id = ar.id
+            where ar.action = :action
+            and ({" or ".join(key_conditions)})
+            and (p.expires_at is null or p.expires_at > :now)
+        ),
+        access as (
+            select user_id, null as group_id
+            from grants where user_id is not null
+            union
+            select gm.user_id, gm.group_id
+            from grants
+            join group_membership gm on gm.group_id = grants.group_id
+            where (gm.expires_at is null or gm.expires_at > :now)
+        )
+        select u.id, u.lookup, u.value, u.description,
+            max(access.group_id is null) as direct,
+            group_concat(grp.name, ', ') as via
+        from access
+        join users u on u.id = access.user_id
+        left join groups grp on grp.id = access.group_id
+        group by u.id
+        order by u.id
+    """
+    return db.execute(query, data)
 
 
 def check_permission(actor, action, resource, db, authed_users, relevant_actions):
+    # expired rows are ignored here, so access ends at exactly expires_at
+    # even if the sweeper hasn't deleted them yet
+    now = {"now": time.time()}
     user_ids = ",".join([
         str(a[0]) for a in authed_users or []
     ])
+    # NOTE: plain queries, db[table].rows_where also checks sqlite_master
+    # for the table, twice, every time
     group_ids = ",".join(set([
-        str(g["group_id"]) for g in db["group_membership"].rows_where(
-            f"user_id in ({user_ids})"
-        )
+        str(g[0]) for g in db.execute(
+            "select group_id from group_membership "
+            f"where user_id in ({user_ids}) and {NOT_EXPIRED}", now
+        ).fetchall()
     ]))
     ar_ids = ",".join([
         str(a[0]) for a in relevant_actions or []
@@ -592,8 +1567,11 @@ def check_permission(actor, action, resource, db, authed_users, relevant_actions
     cond = " and ".join([
         f"actions_resources_id in ({ar_ids})",
         f"(user_id in ({user_ids}) or group_id in ({group_ids}))",
+        NOT_EXPIRED,
     ])
-    perms = [p for p in db["permissions"].rows_where(cond)]
+    perms = db.execute(
+        f"select id from permissions where {cond} limit 1", now
+    ).fetchall()
     for perm in perms:
         return True
     if actor and actor.get("id") == "root":
@@ -609,18 +1587,38 @@ def check_permission(actor, action, resource, db, authed_users, relevant_actions
 @hookimpl
 def permission_allowed(datasette, actor, action, resource):
     async def inner_permission_allowed():
-        db = get_db(datasette)
-        authed_users = bootstrap_and_fetch_users(db, actor)
-        relevant_actions = bootstrap_and_fetch_actions_resources(
-            db, action, resource
-        )
-        return check_permission(
-            actor, action, resource, db, authed_users, relevant_actions
-        )
+        return await get_store(datasette).allowed_async(actor, action, resource)
 
     return inner_permission_allowed
 
 
+@hookimpl
+def actor_from_request(datasette, request):
+    """
+    Turn "Authorization: Bearer dlp_..." headers into token actors, these
+    get resolved straight to the token's user by permission checks.
+    """
+    authorization = request.headers.get("authorization") or ""
+    if not authorization.startswith(f"Bearer {TOKEN_PREFIX}"):
+        return None
+
+    async def inner_actor_from_request():
+        store = get_store(datasette)
+        token_hash = hash_token(authorization[len("Bearer "):])
+        token = await store.execute_fn(
+            lambda db: store.get_token(token_hash=token_hash)
+        )
+        if token is None:
+            return None
+        return {
+            "id": f"token:{token['id']}",
+            "token": TOKEN_ACTOR_TYPE,
+            "token_id": token["id"],
+        }
+
+    return inner_actor_from_request
+
+
 @hookimpl
 def menu_links(datasette, actor):
     async def inner():
@@ -655,6 +1653,9 @@ def database_actions(datasette, actor, database):
 @hookimpl
 def register_routes():
     return [
+        (r"^/-/live-permissions/changes/?$", perms_changes),
+        (r"^/-/live-permissions/trace/?$", perms_trace),
+        (r"^/-/live-permissions/report(\.(?P<format>json|csv))?/?$", perms_report),
         (r"^/-/live-permissions/db/manage/(?P<database>.*)/?$", manage_db_group),
         (r"^/-/live-permissions/(?P<table>.*)/(?P<id>.*)/?$", perms_crud),
     ]
@@ -674,7 +1675,7 @@ async def perms_crud(scope, receive, datasette, request):
     assert request.method in ["POST", "DELETE"], "Bad method"
     assert table in KNOWN_TABLES, "Bad table name provided"
 
-    db = get_db(datasette)
+    store = get_store(datasette)
     # POST is just dual update/create (depending on if id=="new")
     if request.method == "POST":
         formdata = await request.post_vars()
@@ -682,12 +1683,35 @@ async def perms_crud(scope, receive, datasette, request):
         if "csrftoken" in formdata:
             del formdata["csrftoken"]
 
-        pk = "id"
-        if table == "group_membership":
-            pk = ("group_id", "user_id")
-        db[table].insert(
-            formdata, pk=pk, alter=False, replace=False
+        if table in EXPIRING_TABLES and "expires_at" in formdata:
+            try:
+                formdata["expires_at"] = parse_expires_at(formdata["expires_at"])
+            except ValueError as e:
+                return Response.json({"error": str(e)}, status=400)
+
+        # tokens get generated, the secret is only ever shown here
+        if table == "tokens":
+            token_id, secret = await store.execute_fn(
+                lambda db: store.create_token(
+                    user_id=formdata.get("user_id") or None,
+                    description=formdata.get("description") or None,
+                    expires_at=formdata.get("expires_at"),
+                )
+            )
+            return Response.json({"ok": True, "id": token_id, "token": secret})
+
+        await store.execute_fn(
+            lambda db: store.mutate(table, "insert", data=formdata)
         )
+        # the editor submits via fetch and picks the new row up from
+        # the change feed instead of reloading the page
+        if "application/json" in request.headers.get("accept", ""):
+            return Response.json({
+                "ok": True,
+                "version": await store.execute_fn(
+                    lambda db: store.change_version()
+                ),
+            })
         return Response.redirect(next)
 
     elif request.method == "DELETE":
@@ -695,13 +1719,148 @@ async def perms_crud(scope, receive, datasette, request):
             obj_id = int(obj_id)
         except ValueError:
             obj_id = tuple(int(i) for i in obj_id.split(","))
-        db[table].delete(obj_id)
+        await store.execute_fn(
+            lambda db: store.mutate(table, "delete", pk=obj_id)
+        )
         return Response.text('', status=204)
 
     else:
         raise NotImplementedError("Bad HTTP method!")
 
 
+async def perms_changes(scope, receive, datasette, request):
+    """
+    Change feed for the permissions editor. Long-polls until there are
+    changes after the `since` version (optionally for a single `table`)
+    and returns them as row-level diffs. Without `since` it returns the
+    current version immediately, so clients know where to start from.
+    """
+    if not await datasette.permission_allowed(
+        request.actor, "live-permissions-edit", default=False
+    ):
+        raise Forbidden("Permission denied")
+
+    table = request.args.get("table")
+    if table and table not in KNOWN_TABLES:
+        return Response.json({"error": "Bad table name provided"}, status=400)
+    try:
+        since = request.args.get("since")
+        if since is not None:
+            since = int(since)
+        timeout = float(request.args.get("timeout", DEFAULT_CHANGES_TIMEOUT))
+    except ValueError:
+        return Response.json({
+            "error": "since must be an integer and timeout a number"
+        }, status=400)
+    if not math.isfinite(timeout) or timeout < 0:
+        return Response.json({
+            "error": "timeout must be a positive number of seconds"
+        }, status=400)
+    timeout = min(timeout, MAX_CHANGES_TIMEOUT)
+
+    store = get_store(datasette)
+    version = await store.execute_fn(lambda db: store.change_version())
+    if since is None:
+        return Response.json({"version": version, "changes": []})
+
+    oldest = await store.execute_fn(lambda db: store.oldest_change_version())
+    if since > version or (oldest is not None and since < oldest - 1):
+        # the client is out of sync with the log, it needs to reload
+        return Response.json({"version": version, "reset": True, "changes": []})
+
+    deadline = time.time() + timeout
+    while True:
+        changes = await store.execute_fn(lambda db: store.changes(since, table))
+        if changes or time.time() >= deadline:
+            break
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+    return Response.json({
+        "version": await store.execute_fn(lambda db: store.change_version()),
+        "changes": changes,
+    })
+
+
+async def perms_trace(scope, receive, datasette, request):
+    """
+    Returns the SQL traces of the latest permission checks, newest first,
+    when the "trace" plugin config option is on.
+    """
+    if not await datasette.permission_allowed(
+        request.actor, "permissions-debug", default=False
+    ):
+        raise Forbidden("Permission denied")
+
+    sql_tracer = get_store(datasette).sql_tracer
+    if not sql_tracer:
+        return Response.json({
+            "error": "Tracing is off, set the \"trace\" plugin option"
+        }, status=400)
+    return Response.json(list(reversed(sql_tracer.traces)), default=repr)
+
+
+async def perms_report(scope, receive, datasette, request):
+    """
+    Streams the users with access to an `action` (and optionally a
+    `database` and `table`), as JSON or CSV. See access_report.
+    """
+    action = request.args.get("action")
+    database = request.args.get("database") or None
+    table = request.args.get("table") or None
+    fmt = request.url_vars.get("format") or "json"
+
+    if not await datasette.permission_allowed(
+        request.actor, "live-permissions-edit", database, default=False
+    ):
+        raise Forbidden("Permission denied")
+
+    assert action, "An action is required"
+    assert database or not table, "A table requires a database"
+
+    store = get_store(datasette)
+    report = await store.execute_fn(
+        lambda db: store.access_report(action, database, table)
+    )
+
+    async def fetch_batch():
+        return await store.execute_fn(
+            lambda db: list(itertools.islice(report, REPORT_BATCH_SIZE))
+        )
+
+    async def stream_json(r):
+        await r.write("[")
+        first = True
+        while True:
+            rows = await fetch_batch()
+            if not rows:
+                break
+            chunk = ",\n".join([
+                json.dumps(dict(zip(REPORT_COLUMNS, row), direct=bool(row[4])))
+                for row in rows
+            ])
+            await r.write(chunk if first else f",\n{chunk}")
+            first = False
+        await r.write("]")
+
+    async def stream_csv(r):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(REPORT_COLUMNS)
+        while True:
+            rows = await fetch_batch()
+            if not rows:
+                break
+            writer.writerows(rows)
+            await r.write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+        await r.write(buffer.getvalue())
+
+    if fmt == "csv":
+        return AsgiStream(stream_csv, content_type="text/csv; charset=utf-8")
+    return AsgiStream(stream_json, content_type="application/json; charset=utf-8")
+
+
 async def manage_db_group(scope, receive, datasette, request):
     db_name = unquote_plus(request.url_vars["database"])
     if not await datasette.permission_allowed(
@@ -709,20 +1868,18 @@ async def manage_db_group(scope, receive, datasette, request):
     ):
         raise Forbidden("Permission denied")
 
-    db = get_db(datasette)
+    store = get_store(datasette)
 
-    group_id = None
-    results = db["groups"].rows_where("name=?", [f"DB Access: {db_name}"])
-    for row in results:
-        group_id = row["id"]
-        break
+    group_id = await store.execute_fn(
+        lambda db: store.find_group(f"DB Access: {db_name}")
+    )
 
     assert db_name in datasette.databases, "Non-existant database!"
 
     if not group_id and db_name not in BLOCKED_DB_ACTIONS:
-        db["groups"].insert({
+        await store.execute_fn(lambda db: store.mutate("groups", "upsert", data={
             "name": f"DB Access: {db_name}",
-        }, pk="id", replace=True)
+        }))
         return await manage_db_group(scope, receive, datasette, request)
 
     if request.method in ["POST", "DELETE"]:
@@ -730,23 +1887,26 @@ async def manage_db_group(scope, receive, datasette, request):
         user_id = formdata["user_id"]
 
         if request.method == "POST":
-            db["group_membership"].insert({
-                "group_id": group_id,
-                "user_id": user_id,
-            }, replace=True)
+            try:
+                expires_at = parse_expires_at(formdata.get("expires_at"))
+            except ValueError as e:
+                return Response.json({"error": str(e)}, status=400)
+            await store.execute_fn(lambda db: store.mutate(
+                "group_membership", "upsert", data={
+                    "group_id": group_id,
+                    "user_id": user_id,
+                    "expires_at": expires_at,
+                }
+            ))
         elif request.method == "DELETE":
-            db["group_membership"].delete((group_id, user_id))
+            await store.execute_fn(lambda db: store.mutate(
+                "group_membership", "delete", pk=(group_id, user_id)
+            ))
             return Response.text('', status=204)
         else:
             raise NotImplementedError(f"Bad method: {request.method}")
 
-    perms_query = """
-        select distinct user_id as id, lookup, value, description
-        from group_membership join users
-        on group_membership.user_id = users.id
-        where group_membership.group_id=?
-    """
-    users = db.execute(perms_query, (group_id,))
+    users = await store.execute_fn(lambda db: store.group_members(group_id))
     return Response.html(
         await datasette.render_template(
             "database_management.html", {
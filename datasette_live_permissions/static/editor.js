@@ -18,6 +18,14 @@ async function doDelete(url_path, body) {
   return response;
 }
 
+// tables the change feed can keep up to date in place
+const LIVE_PERMISSIONS_TABLES = [
+  "users", "groups", "group_membership", "actions_resources", "permissions",
+  "tokens",
+];
+// set once the change feed is running, so we can skip page reloads
+let watchingChanges = false;
+
 function lastPathPart() {
   const parts = document.location.pathname.split("/").filter(x=>x);
   return parts[parts.length-1];
@@ -64,7 +72,9 @@ async function deleteItem(e) {
   const url_path = `${base_url}/-/live-permissions/${table}/${objId}`;
 
   const response = await doDelete(url_path);
-  if (response.status === 204) document.location.reload();
+  if (response.status !== 204) return;
+  // the change feed will remove the row for us
+  if (!watchingChanges) document.location.reload();
 }
 
 async function deleteItemDB(e) {
@@ -90,6 +100,147 @@ function addTrashCans() {
   $('.delete-item-db').on("click", deleteItemDB);
 }
 
+function findRow(pk) {
+  return $(".rows-and-columns tbody tr").filter(function() {
+    const cols = $(this).find("td.type-pk");
+    return cols[0] && cols[0].innerText.trim() === pk;
+  });
+}
+
+/**
+ * Build a table row for a change feed row, in the same column order
+ * as the table header rendered by Datasette. Columns the feed leaves
+ * out (e.g., token hashes) keep the cell from the existing row.
+ */
+function buildRow(change, existing) {
+  const tr = $("<tr></tr>");
+  $(".rows-and-columns thead th[data-column]").each(function() {
+    const column = $(this).attr("data-column");
+    const isPk = $(this).attr("data-is-pk") === "1";
+    const kept = existing.find(`td.col-${column}`);
+    if (!(column in change.row) && !isPk && kept.length) {
+      tr.append(kept.first().clone());
+      return;
+    }
+    const value = column in change.row ? change.row[column] : change.pk;
+    const td = $("<td></td>")
+      .addClass(`col-${column}`)
+      .addClass(isPk || !(column in change.row) ? "type-pk" : "")
+      .text(value === null ? "" : value);
+    tr.append(td);
+  });
+  const trash = $("<td class='delete-item'>🗑️</td>");
+  trash.on("click", deleteItem);
+  tr.append(trash);
+  return tr;
+}
+
+// rows added since the page loaded, which may or may not match its
+// filters, sort order and page
+let newRows = 0;
+
+/**
+ * Tell the user there are new rows, rather than guessing whether and
+ * where they belong on this page.
+ */
+function showNewRows() {
+  newRows += 1;
+  let notice = $("#live-permissions-new-rows");
+  if (!notice.length) {
+    notice = $("<p id='live-permissions-new-rows'></p>");
+    const table = $(".rows-and-columns, .zero-results").first();
+    if (table.length) {
+      table.before(notice);
+    } else {
+      $("#live-permissions-app").before(notice);
+    }
+  }
+  const text = newRows === 1 ? "1 new row" : `${newRows} new rows`;
+  notice.empty().append(
+    $("<a href='#'></a>").text(`${text}, reload to show`).on("click", (e) => {
+      e.preventDefault();
+      document.location.reload();
+    })
+  );
+}
+
+/**
+ * Only rows already on the page get updated or removed in place.
+ */
+function applyChange(change) {
+  const existing = findRow(change.pk);
+  if (change.op === "delete") {
+    existing.remove();
+  } else if (existing.length) {
+    existing.first().replaceWith(buildRow(change, existing.first()));
+    existing.slice(1).remove();
+  } else if (change.op === "insert") {
+    showNewRows();
+  }
+}
+
+/**
+ * Long-poll the change feed and apply row-level diffs to the table
+ * in place, instead of reloading the whole page after every edit.
+ */
+async function watchChanges(table) {
+  const base_url = get_base_url();
+  const feed_url = `${base_url}/-/live-permissions/changes?table=${table}`;
+  let response = await fetch(feed_url);
+  if (!response.ok) return;
+  let version = (await response.json()).version;
+  watchingChanges = true;
+
+  while (true) {
+    try {
+      response = await fetch(`${feed_url}&since=${version}`);
+      if (!response.ok) throw new Error(`Bad response: ${response.status}`);
+      const data = await response.json();
+      if (data.reset) {
+        document.location.reload();
+        return;
+      }
+      data.changes.forEach(applyChange);
+      version = data.version;
+    } catch (e) {
+      console.error("Change feed error", e);
+      await new Promise((resolve) => setTimeout(resolve, 5000));
+    }
+  }
+}
+
+/**
+ * Submit the add forms via fetch. Reload to show the new row, unless
+ * it's an API token, which has to stay on screen to be copied.
+ */
+async function submitForm(e) {
+  if (!watchingChanges) return;
+  e.preventDefault();
+  const form = e.target;
+  const response = await fetch(form.action, {
+    method: "POST",
+    headers: {
+      "Accept": "application/json",
+      "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
+    },
+    body: new URLSearchParams(new FormData(form)),
+  });
+  if (!response.ok) {
+    alert(`Failed to save: ${response.status}`);
+    return;
+  }
+  // new API tokens are only ever shown once, in the response
+  const data = await response.json();
+  if (!data.token) {
+    document.location.reload();
+    return;
+  }
+  $(form).find(".created-token code").text(data.token);
+  $(form).find(".created-token").show();
+  $(form).find("input:not([type=hidden]):not([type=submit])").val("");
+  $(form).find("select").val(null).trigger("change");
+}
+
 function s2_data(type, params) {
   switch(type) {
     case 'action-resource':
@@ -181,6 +332,12 @@ function setup() {
   });
 
   addTrashCans();
+
+  const table = lastPathPart();
+  if (LIVE_PERMISSIONS_TABLES.includes(table)) {
+    $("#live-permissions-app form").on("submit", submitForm);
+    watchChanges(table);
+  }
 }
 
 $(document).ready(setup);
@@ -1,6 +1,12 @@
 from datasette.app import Datasette
 import pytest
+import asyncio
+import gc
+import json
 import os
+import re
+import threading
+import time
 
 import sqlite3
 import sqlite_utils
@@ -33,7 +39,528 @@ async def test_can_create_tables():
     database_path = os.path.join(datasette_live_permissions.DEFAULT_DBPATH,
                                  f"{datasette_live_permissions.DB_NAME}.db")
     db = sqlite_utils.Database(sqlite3.connect(database_path))
-    datasette_live_permissions.create_tables()
+    datasette_live_permissions.create_tables(datasette)
     for table in datasette_live_permissions.KNOWN_TABLES:
         print(f"{table} in tables?")
         assert table in db.table_names()
+
+
+def make_datasette(**config):
+    return Datasette([], memory=True, metadata={
+        "plugins": {
+            "datasette-live-permissions": dict({"storage": "memory"}, **config),
+        },
+    })
+
+
+@pytest.mark.asyncio
+async def test_expired_permissions_are_ignored_and_swept():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    actor = {"id": "alice"}
+    # first check bootstraps the user and action-resource
+    assert not await datasette.permission_allowed(actor, "do-thing")
+    db = datasette_live_permissions.get_db(datasette)
+    user_id = next(db["users"].rows_where("value = ?", ["alice"]))["id"]
+    ar_id = next(db["actions_resources"].rows_where("action = ?", ["do-thing"]))["id"]
+
+    db["permissions"].insert({
+        "actions_resources_id": ar_id,
+        "user_id": user_id,
+        "expires_at": datasette_live_permissions.parse_expires_at("2000-01-01"),
+    })
+    assert not await datasette.permission_allowed(actor, "do-thing")
+
+    with db.conn:
+        db.execute(
+            "update permissions set expires_at = ? where user_id = ?",
+            [time.time() + 3600, user_id],
+        )
+    assert await datasette.permission_allowed(actor, "do-thing")
+    assert datasette_live_permissions.next_expiry(db) is not None
+
+    assert datasette_live_permissions.sweep_expired(
+        db, now=time.time() + 7200, batch_size=1
+    ) == 1
+    assert not await datasette.permission_allowed(actor, "do-thing")
+
+
+@pytest.mark.asyncio
+async def test_bad_expires_at_is_rejected():
+    datasette = make_datasette()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get("/live_permissions/permissions", cookies=cookies)
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+    data = {"csrftoken": cookies["ds_csrftoken"], "expires_at": "next week"}
+    for path in ["/-/live-permissions/permissions/new",
+                 "/-/live-permissions/db/manage/_memory"]:
+        response = await datasette.client.post(
+            path, data=dict(data, user_id="1", actions_resources_id="1"),
+            cookies=cookies,
+        )
+        assert response.status_code == 400, path
+        assert "next week" in response.json()["error"]
+    with pytest.raises(ValueError):
+        datasette_live_permissions.parse_expires_at("nan")
+
+
+@pytest.mark.asyncio
+async def test_sweeper_survives_errors(monkeypatch):
+    datasette = make_datasette(expiry_sweep_interval=0.01)
+    store = datasette_live_permissions.get_store(datasette)
+    await store.execute_fn(lambda db: datasette_live_permissions.create_tables(datasette))
+    sweeps = []
+
+    def sweep_expired(db, batch_size):
+        sweeps.append(batch_size)
+        if len(sweeps) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return 0
+
+    monkeypatch.setattr(datasette_live_permissions, "sweep_expired", sweep_expired)
+    task = asyncio.ensure_future(
+        datasette_live_permissions.sweep_expired_forever(store)
+    )
+    for _ in range(100):
+        if len(sweeps) > 1:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    assert len(sweeps) > 1
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.asyncio
+async def test_change_feed_returns_row_diffs():
+    datasette = make_datasette()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/live-permissions/changes?table=groups", cookies=cookies
+    )
+    assert response.status_code == 200
+    version = response.json()["version"]
+
+    db = datasette_live_permissions.get_db(datasette)
+    db["groups"].insert({"name": "Contractors"}, pk="id")
+    db["users"].insert({"lookup": "actor.id", "value": "bob"}, pk="id")
+
+    response = await datasette.client.get(
+        f"/-/live-permissions/changes?table=groups&since={version}&timeout=0",
+        cookies=cookies,
+    )
+    data = response.json()
+    assert data["version"] == version + 2
+    assert len(data["changes"]) == 1
+    change = data["changes"][0]
+    assert change["op"] == "insert"
+    assert change["row"]["name"] == "Contractors"
+    assert change["pk"] == str(change["row"]["id"])
+
+    db["groups"].delete(change["row"]["id"])
+    response = await datasette.client.get(
+        f"/-/live-permissions/changes?since={data['version']}&timeout=0",
+        cookies=cookies,
+    )
+    assert [(c["op"], c["pk"]) for c in response.json()["changes"]] == [
+        ("delete", change["pk"])
+    ]
+
+    for query in ["since=abc", "since=0&timeout=soon", "since=0&timeout=nan",
+                  "since=0&timeout=-1", "table=nope"]:
+        response = await datasette.client.get(
+            f"/-/live-permissions/changes?{query}", cookies=cookies,
+        )
+        assert response.status_code == 400, query
+
+    # bootstrapped actions_resources rows are logged once, with their key
+    version = datasette_live_permissions.latest_change_version(db)
+    await datasette.permission_allowed({"id": "bob"}, "do-thing")
+    response = await datasette.client.get(
+        f"/-/live-permissions/changes?table=actions_resources&since={version}&timeout=0",
+        cookies=cookies,
+    )
+    changes = response.json()["changes"]
+    assert [c["op"] for c in changes] == ["insert"]
+    assert changes[0]["row"]["resource_key"] is not None
+
+
+@pytest.mark.asyncio
+async def test_grants_apply_to_child_resources():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    actor = {"id": "alice"}
+    resource = ("fixtures", "facetable")
+    assert not await datasette.permission_allowed(actor, "view-table", resource)
+
+    db = datasette_live_permissions.get_db(datasette)
+    # table-level rows aren't bootstrapped, the database-level one is
+    keys = [r["resource_key"] for r in db["actions_resources"].rows_where(
+        "action = ?", ["view-table"]
+    )]
+    assert "fixtures" in keys
+    assert "fixtures/facetable" not in keys
+
+    user_id = next(db["users"].rows_where("value = ?", ["alice"]))["id"]
+    ar_id = next(db["actions_resources"].rows_where(
+        "action = ? and resource_key = ?", ["view-table", "fixtures"]
+    ))["id"]
+    db["permissions"].insert({"actions_resources_id": ar_id, "user_id": user_id})
+    assert await datasette.permission_allowed(actor, "view-table", resource)
+    assert not await datasette.permission_allowed(
+        actor, "view-table", ("other", "facetable")
+    )
+
+    # keys are kept up to date for rows added outside the plugin
+    db["actions_resources"].insert({
+        "action": "view-table",
+        "resource_primary": "fixtures",
+        "resource_secondary": "facetable",
+    })
+    assert db.execute(
+        "select count(*) from actions_resources where resource_key = ?",
+        ["fixtures/facetable"],
+    ).fetchone()[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_skips_disk(tmp_path):
+    datasette = make_datasette(db_path=str(tmp_path))
+    store = datasette_live_permissions.get_store(datasette)
+    assert isinstance(store, datasette_live_permissions.MemoryStore)
+    assert store is datasette_live_permissions.get_store(datasette)
+    datasette_live_permissions.create_tables(datasette)
+    assert await datasette.permission_allowed({"id": "root"}, "view-instance")
+    store.mutate("groups", "insert", data={"name": "Contractors"})
+
+    assert not os.listdir(tmp_path)
+    # the in-memory database is the one Datasette serves
+    response = await datasette.client.get(
+        "/live_permissions/groups.json?name=Contractors&_shape=array",
+        cookies={"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert [g["name"] for g in response.json()] == ["Contractors"]
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_reads_dont_block_checks():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    ds_db = datasette.get_database("live_permissions")
+    # a Datasette read (e.g., an editor page) still part way through
+    cursor = await ds_db.execute_fn(lambda conn: conn.execute("select * from users"))
+    first = await ds_db.execute_fn(lambda conn: cursor.fetchone())
+    assert first["lookup"]
+    # a check for a new actor writes to the users table meanwhile
+    assert not await datasette.permission_allowed({"id": "newcomer"}, "do-thing")
+    await ds_db.execute_fn(lambda conn: cursor.fetchall())
+    response = await datasette.client.get(
+        "/live_permissions/users.json?value=newcomer&_shape=array",
+        cookies={"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert [u["value"] for u in response.json()] == ["newcomer"]
+
+
+@pytest.mark.asyncio
+async def test_access_report():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    db = datasette_live_permissions.get_db(datasette)
+    bob = db["users"].insert({"lookup": "actor.id", "value": "bob"}).last_pk
+    carol = db["users"].insert({"lookup": "actor.id", "value": "carol"}).last_pk
+    db["users"].insert({"lookup": "actor.id", "value": "dave"})
+    group = db["groups"].insert({"name": "Contractors"}).last_pk
+    db["group_membership"].insert({"group_id": group, "user_id": bob})
+    db_ar = db["actions_resources"].insert({
+        "action": "view-table", "resource_primary": "fixtures",
+    }).last_pk
+    table_ar = db["actions_resources"].insert({
+        "action": "view-table", "resource_primary": "fixtures",
+        "resource_secondary": "facetable",
+    }).last_pk
+    db["permissions"].insert({"actions_resources_id": db_ar, "group_id": group})
+    db["permissions"].insert({"actions_resources_id": table_ar, "user_id": carol})
+    # bob also has a direct grant
+    db["permissions"].insert({"actions_resources_id": table_ar, "user_id": bob})
+
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/live-permissions/report.json?action=view-table&database=fixtures",
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    assert [(r["value"], r["direct"], r["via"]) for r in response.json()] == [
+        ("bob", True, "Contractors"), ("carol", True, None),
+    ]
+
+    response = await datasette.client.get(
+        "/-/live-permissions/report.csv?action=view-table"
+        "&database=fixtures&table=other",
+        cookies=cookies,
+    )
+    assert response.text.splitlines() == [
+        "id,lookup,value,description,direct,via",
+        f"{bob},actor.id,bob,,0,Contractors",
+    ]
+
+
+def table_accesses(plan):
+    """
+    The (table, plan detail) pairs for the SCAN and SEARCH lines of a
+    plan. SQLite before 3.36 says e.g. "SCAN TABLE users", newer ones
+    "SCAN users".
+    """
+    accesses = []
+    for detail in plan or []:
+        match = re.match(r"^(?:SCAN|SEARCH) (?:TABLE )?(\S+)", detail)
+        if match:
+            accesses.append((match.group(1), detail))
+    return accesses
+
+
+# (table, SQL fragment) pairs whose scans are expected, e.g., tiny tables
+ALLOWED_SCANS = []
+
+
+def full_table_scans(plan, sql=""):
+    """
+    Plan details that read all of one of the plugin's tables, including
+    full scans of an index (scans of sqlite_master, CTEs, etc don't
+    count), unless the statement is in ALLOWED_SCANS. Searches that only
+    use an expires_at index count too: most rows never expire, so
+    "expires_at is null" matches nearly the whole table.
+    """
+    scans = []
+    for table, detail in table_accesses(plan):
+        if table not in datasette_live_permissions.KNOWN_TABLES:
+            continue
+        if any(t == table and f in sql for t, f in ALLOWED_SCANS):
+            continue
+        if re.search(r" USING INDEX idx_\w+_expires_at ", detail):
+            scans.append(detail)
+        elif detail.startswith("SCAN "):
+            scans.append(detail)
+    return scans
+
+
+@pytest.mark.asyncio
+async def test_hot_path_queries_use_indexes():
+    datasette = make_datasette(trace=True)
+    datasette_live_permissions.create_tables(datasette)
+    store = datasette_live_permissions.get_store(datasette)
+    db = store.get_db()
+    group = db["groups"].insert({"name": "Contractors"}).last_pk
+    bob = db["users"].insert({"lookup": "actor.id", "value": "bob"}).last_pk
+    db["group_membership"].insert({
+        "group_id": group, "user_id": bob, "expires_at": time.time() + 60,
+    })
+    token_id, _ = store.create_token(description="CI bot")
+    token_actor = {"id": "token:1", "token": "live_permissions", "token_id": token_id}
+
+    checks = [
+        ("view-instance", None),
+        ("view-database", "fixtures"),
+        ("view-table", ("fixtures", "facetable")),
+    ]
+    # run twice: once bootstrapping users and resources, once looking up
+    for _ in range(2):
+        actors = [None, {"id": "root"}, {"id": "bob"}, {"id": "carol"}, token_actor]
+        for actor in actors:
+            for action, resource in checks:
+                await datasette.permission_allowed(actor, action, resource)
+
+    traces = list(store.sql_tracer.traces)
+    assert len(traces) == 30
+    accessed = set()
+    for trace in traces:
+        assert trace["statements"]
+        for statement in trace["statements"]:
+            accessed.update(t for t, _ in table_accesses(statement["plan"]))
+            assert not full_table_scans(statement["plan"], statement["sql"]), statement
+    # make sure the plans were actually understood
+    assert {"users", "permissions", "actions_resources"} <= accessed
+
+    store.sql_tracer.start(action="report")
+    datasette_live_permissions.access_report(db, "view-table", "fixtures")
+    trace = store.sql_tracer.finish()
+    for statement in trace["statements"]:
+        assert statement["plan"]
+        assert not full_table_scans(statement["plan"], statement["sql"]), statement
+
+    response = await datasette.client.get(
+        "/-/live-permissions/trace",
+        cookies={"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert response.status_code == 200
+    assert response.json()[0]["action"] == "permissions-debug"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_checks_are_coalesced():
+    datasette = make_datasette(trace=True)
+    datasette_live_permissions.create_tables(datasette)
+    store = datasette_live_permissions.get_store(datasette)
+    actor = {"id": "alice"}
+
+    results = await asyncio.gather(*[
+        datasette.permission_allowed(actor, "view-instance") for _ in range(20)
+    ] + [
+        datasette.permission_allowed(actor, "view-database", "fixtures")
+    ])
+    assert results == [True] * 20 + [False]
+    assert len(store.sql_tracer.traces) == 2
+    assert not store.in_flight
+
+    # once finished, the next check is evaluated again
+    assert await datasette.permission_allowed(actor, "view-instance")
+    assert len(store.sql_tracer.traces) == 3
+    users = store.get_db().execute(
+        "select count(*) from users where value = 'alice'"
+    ).fetchone()[0]
+    assert users == 1
+
+
+@pytest.mark.asyncio
+async def test_api_tokens():
+    datasette = make_datasette(trace=True)
+    datasette_live_permissions.create_tables(datasette)
+    store = datasette_live_permissions.get_store(datasette)
+    db = store.get_db()
+    token_id, secret = store.create_token(description="CI bot")
+    assert secret.startswith("dlp_")
+    row = db["tokens"].get(token_id)
+    assert row["token_hash"] == datasette_live_permissions.hash_token(secret)
+    assert secret not in json.dumps(list(db["tokens"].rows))
+    # token hashes stay out of the change feed
+    changes = datasette_live_permissions.fetch_changes(db, 0, "tokens")
+    assert changes and all("token_hash" not in c["row"] for c in changes)
+
+    response = await datasette.client.get(
+        "/-/actor.json", headers={"Authorization": f"Bearer {secret}"}
+    )
+    actor = response.json()["actor"]
+    assert actor["token_id"] == token_id
+    response = await datasette.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer dlp_nope"}
+    )
+    assert response.json()["actor"] is None
+    # unknown tokens aren't cached, so they can't evict valid ones
+    assert ("hash", datasette_live_permissions.hash_token("dlp_nope")) not in store.token_cache
+    assert ("hash", row["token_hash"]) in store.token_cache
+
+    # the token's user can be granted permissions like any other
+    ar_id = db["actions_resources"].insert({"action": "deploy"}).last_pk
+    db["permissions"].insert({
+        "actions_resources_id": ar_id, "user_id": row["user_id"],
+    })
+    assert await datasette.permission_allowed(actor, "deploy")
+    statements = [s["sql"] for s in store.sql_tracer.traces[-1]["statements"]]
+    assert not [s for s in statements if "with recursive lookups" in s]
+
+    # revoking a token through the plugin takes effect right away
+    store.mutate("tokens", "delete", pk=token_id)
+    assert not await datasette.permission_allowed(actor, "deploy")
+
+    # the token's user goes with it and its id is never handed out again
+    assert not list(db["users"].rows_where("id = ?", [row["user_id"]]))
+    assert not list(db["permissions"].rows_where("user_id = ?", [row["user_id"]]))
+    assert not list(db["group_membership"].rows_where("user_id = ?", [row["user_id"]]))
+    next_id, _ = store.create_token(expires_at=time.time() - 1)
+    assert next_id > token_id
+    next_user_id = db["tokens"].get(next_id)["user_id"]
+    datasette_live_permissions.sweep_expired(db)
+    assert not list(db["users"].rows_where("id = ?", [next_user_id]))
+
+
+@pytest.mark.asyncio
+async def test_token_users_only_match_their_token():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    store = datasette_live_permissions.get_store(datasette)
+    db = store.get_db()
+    # another token system already matches actors by token_id
+    other_actor = {"id": "x", "token_id": 1}
+    other_user_id = db["users"].insert({
+        "lookup": "actor.token_id", "value": "1",
+    }).last_pk
+    other_user = db["users"].get(other_user_id)
+    read_id = db["actions_resources"].insert({"action": "read"}).last_pk
+    db["permissions"].insert({
+        "actions_resources_id": read_id, "user_id": other_user["id"],
+    })
+    assert await datasette.permission_allowed(other_actor, "read")
+
+    token_id, _ = store.create_token(description="CI bot")
+    assert token_id == 1
+    token_actor = {"id": "token:1", "token": "live_permissions", "token_id": 1}
+    deploy_id = db["actions_resources"].insert({"action": "deploy"}).last_pk
+    db["permissions"].insert({
+        "actions_resources_id": deploy_id,
+        "user_id": db["tokens"].get(token_id)["user_id"],
+    })
+    assert db["users"].get(other_user["id"]) == other_user
+    assert await datasette.permission_allowed(other_actor, "read")
+    assert not await datasette.permission_allowed(other_actor, "deploy")
+    assert await datasette.permission_allowed(token_actor, "deploy")
+
+    # deleting the token leaves users it wasn't made for alone
+    store.mutate("tokens", "delete", pk=token_id)
+    assert db["users"].get(other_user["id"]) == other_user
+    assert await datasette.permission_allowed(other_actor, "read")
+
+
+@pytest.mark.asyncio
+async def test_checks_and_edits_share_the_store_safely():
+    datasette = make_datasette()
+    datasette_live_permissions.create_tables(datasette)
+    store = datasette_live_permissions.get_store(datasette)
+
+    def add_group(i):
+        return store.execute_fn(lambda db: store.mutate(
+            "groups", "upsert", data={"name": f"Group {i % 10}"}
+        ))
+
+    await asyncio.gather(*[
+        datasette.permission_allowed({"id": "alice"}, "view-database", f"db{i}")
+        for i in range(200)
+    ] + [add_group(i) for i in range(50)])
+
+    count = await store.execute_fn(lambda db: db.execute(
+        "select count(*) from actions_resources "
+        "where action = 'view-database' and resource_primary like 'db%'"
+    ).fetchone()[0])
+    assert count == 200
+
+
+def test_traces_only_record_their_own_thread():
+    sql_tracer = datasette_live_permissions.SQLTracer()
+    db = datasette_live_permissions.TracingDatabase(
+        sqlite3.connect(":memory:", check_same_thread=False), sql_tracer
+    )
+    sql_tracer.start(action="check")
+    other = threading.Thread(target=lambda: db.execute("select 2").fetchall())
+    other.start()
+    other.join()
+    db.execute("select 1").fetchall()
+    trace = sql_tracer.finish()
+    assert [s["sql"] for s in trace["statements"]] == ["select 1"]
+
+
+@pytest.mark.asyncio
+async def test_stores_are_freed_with_datasette():
+    gc.collect()
+    stores = len(datasette_live_permissions.STORES)
+    threads = threading.active_count()
+    for _ in range(5):
+        datasette = make_datasette()
+        datasette_live_permissions.create_tables(datasette)
+        assert await datasette.permission_allowed({"id": "root"}, "view-instance")
+    del datasette
+    gc.collect()
+    assert len(datasette_live_permissions.STORES) == stores
+    # executor threads exit once shut down
+    for _ in range(50):
+        if threading.active_count() <= threads:
+            break
+        time.sleep(0.01)
+    assert threading.active_count() <= threads